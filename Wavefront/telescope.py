@@ -82,6 +82,24 @@ class Telescope():
 TELESCOPE_DICT = {'LSST': Telescope('LSST', 8.36, 4.85),
                   'GPI': Telescope('GPI', 7.77, 1.024)}
 
+## Cache of pupil masks and unmasked pixel indices
+_PUPIL_CACHE = {}
+
+def get_cached_pupil(telescope_name, shape, pixscale):
+    """Return the (read-only) pupil mask and indices of unmasked pixels for
+    a telescope in TELESCOPE_DICT, computed once per shape and pixel scale.
+    """
+
+    key = (telescope_name, tuple(shape), pixscale)
+
+    if key not in _PUPIL_CACHE:
+        pupil = TELESCOPE_DICT[telescope_name].get_pupil(shape, pixscale)
+        pupil.flags.writeable = False
+        ii, jj = np.nonzero(~pupil)
+        _PUPIL_CACHE[key] = (pupil, ii, jj)
+
+    return _PUPIL_CACHE[key]
+
 
 ###############################################################################
 ##
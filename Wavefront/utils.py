@@ -10,9 +10,10 @@ import treecorr
 ##
 ###############################################################################
 
-def image_to_catalog(image_list, mask=None, is_centered=True):
+def image_to_catalog(image_list, mask=None, is_centered=True, indices=None):
     """Converts a list of images to a catalog.
-       Currently assumed that all images in the list are the same size"""
+       Currently assumed that all images in the list are the same size.
+       Precomputed (ii, jj) indices of unmasked pixels may be provided"""
 
     ## Check if single wavefront or list provided
     if not isinstance (image_list,list): image_list = [image_list]
@@ -20,34 +21,27 @@ def image_to_catalog(image_list, mask=None, is_centered=True):
         raise ValueError("No images provided")
 
     shape = image_list[0].data.shape
-    nX = shape[0]
-    nY = shape[1]
     catalog_list = []
 
     ## Check if mask is provided (may put more mask checks here)
-    if mask is None: mask=make_mask_none(shape)
+    if mask is None: mask = np.ma.make_mask_none(shape)
 
-    ## Create catalog for each image and add to list
-    for image in image_list:
-
-        ## Check mean centered flag
-        if is_centered: image.mean_center(mask=mask)
+    ## Unmasked pixel coordinates are shared by all images
+    if indices is None: indices = np.nonzero(~mask)
+    ii, jj = indices
+    x = ii.astype(np.float64)
+    y = jj.astype(np.float64)
 
-        x = []
-        y = []
-        w = []
+    ## Gather unmasked points of all images, shape (Nimages, Npix)
+    ws = np.empty((len(image_list), len(ii)))
+    for n, image in enumerate(image_list):
+        ws[n] = image.data[ii, jj]
 
-        for i in range(nX):
-            for j in range(nY):
-                if not mask[i,j]:
-                    x.append(float(i))
-                    y.append(float(j))
-                    w.append(image.data[i,j])
-
-        x = np.array(x)
-        y = np.array(y)
-        w = np.array(w)
+    ## Check mean centered flag (centers catalog, not the image)
+    if is_centered: ws -= ws.mean(axis=1, keepdims=True)
 
+    ## Create catalog for each image and add to list
+    for w in ws:
         catalog_list.append(treecorr.Catalog(x=x, y=y, k=w))
 
     return catalog_list 
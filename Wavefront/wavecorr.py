@@ -9,52 +9,53 @@
 
 
 from wavefront import Image, WaveFitter
-from telescope import Telescope, TELESCOPE_DICT
+from telescope import Telescope, TELESCOPE_DICT, get_cached_pupil
 import utils
 import copy
 import waveplot
 import treecorr
 import numpy as np
-from sklearn.neighbors import BallTree
+from scipy.optimize import leastsq
 import matplotlib.pyplot as plt
 
+## GPI pupil pixel scale (m/pixel), also used to convert separations to m
+GPI_PIXSCALE = 7.77/43.
+
 ###############################################################################
 ##
 ## Correlation Functions - xi(r)
 ##
 ###############################################################################
 
-def avg_xi_r(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
+def avg_xi_r(wavefront_list, telescope_name, pixscale=GPI_PIXSCALE, **kwargs):
 
     ## Get correlation parameters
     nbins = kwargs.pop('nbins', 15)
     min_sep = kwargs.pop('min_sep', 1.)
     max_sep = kwargs.pop('max_sep', 40)
+    num_threads = kwargs.pop('num_threads', None)
     is_centered = kwargs.pop('is_centered', True)
 
-    ## Deep copy to avoid altering reusable data
-    wavefront_list = copy.deepcopy(wavefront_list)
-
     ## Check that data is a list
     if not isinstance (wavefront_list,list):
         wavefront_list = [wavefront_list]
     if len(wavefront_list) == 0:
         raise ValueError("No wavefronts provided")
 
-    ## Get telescope from available telescopes in a dictionary
+    ## Get cached pupil for telescope from available telescopes
     shape = wavefront_list[0].data.shape
-    telescope = TELESCOPE_DICT[telescope_name]
-    pupil_mask = telescope.get_pupil(shape, pix_scale=pixscale)
+    pupil_mask, ii, jj = get_cached_pupil(telescope_name, shape, pixscale)
 
     ## Make catalogs from wavefront list
     catalog_list = utils.image_to_catalog(wavefront_list, pupil_mask, 
-                                          is_centered=is_centered)
+                                          is_centered=is_centered, 
+                                          indices=(ii, jj))
 
     ## Calculate xi/varxi zero point (variance)
-    xi_0 = np.zeros(len(wavefront_list))
+    pupil_data = np.empty((len(wavefront_list), len(ii)))
     for i, wavefront in enumerate(wavefront_list):
-        w = np.ma.MaskedArray(wavefront.data, mask=pupil_mask)
-        xi_0[i] = np.var(w)
+        pupil_data[i] = wavefront.data[ii, jj]
+    xi_0 = pupil_data.var(axis=1)
     varxi_0 = xi_0.var(dtype=np.float64)
 
     ## Initialize data vectors
@@ -65,10 +66,11 @@ def avg_xi_r(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
     xi[0,:] = xi_0
     r[0] = 0.0
 
-    ## For each catalog calculate xi using treecorr
+    ## For each catalog calculate xi using treecorr, reusing one object
+    dd = treecorr.KKCorrelation(nbins=nbins, min_sep=min_sep, max_sep=max_sep)
     for i, catalog in enumerate(catalog_list):
-        dd = treecorr.KKCorrelation(nbins=nbins, min_sep=1., max_sep=40)
-        dd.process(catalog)
+        dd.clear()
+        dd.process(catalog, num_threads=num_threads)
         xi[1:,i] = dd.xi
         varxi[1:,i] = dd.varxi
 
@@ -76,7 +78,7 @@ def avg_xi_r(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
     avg_xi = np.mean(xi, axis=1)
     avg_varxi = np.mean(varxi, axis=1)
     avg_varxi[0] = varxi_0
-    r[1:] = 7.77/43.*np.exp(dd.logr)
+    r[1:] = GPI_PIXSCALE*np.exp(dd.logr)
 
     ## Check save flags
     if 'save_file' in kwargs:
@@ -86,7 +88,7 @@ def avg_xi_r(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
 
     return r, avg_xi, avg_varxi
 
-def zernike_xi_r(coefficients, telescope_name, pixscale = 7.77/43*48/256., **kwargs):
+def zernike_xi_r(coefficients, telescope_name, pixscale = GPI_PIXSCALE*48/256., **kwargs):
     """Pixscale is smaller since zernikes are 256x256"""
 
     ## Read in file with zernike fit coefficients
@@ -96,8 +98,8 @@ def zernike_xi_r(coefficients, telescope_name, pixscale = 7.77/43*48/256., **kwa
     avg_zernike = WaveFitter.make_model(avg_coefficients, as_image=True)
 
     if 'save_image' in kwargs:
-        telescope = TELESCOPE_DICT[telescope_name]
-        pupil_mask = telescope.get_pupil((256, 256), pixscale)
+        pupil_mask, _, _ = get_cached_pupil(telescope_name, (256, 256), 
+                                            pixscale)
         avg_zernike.display(mask=pupil_mask, title='Zernike Model for GPI Pupil',
                             cbar_label=r'$\mu \mathrm{{m}}$',
                             save_image=kwargs['save_image'],
@@ -107,20 +109,18 @@ def zernike_xi_r(coefficients, telescope_name, pixscale = 7.77/43*48/256., **kwa
 
     return r, xi, varxi
     
-def residual_xi_r(wavefront_list, coefficients, telescope_name, pixscale = 7.77/43, **kwargs):
+def residual_xi_r(wavefront_list, coefficients, telescope_name, pixscale = GPI_PIXSCALE, **kwargs):
 
-    ## Deep copy to avoid altering reusable data
-    wavefront_list = copy.deepcopy(wavefront_list)
-    
     ## Construct zernike model from average coefficients
     avg_coefficients = np.mean(coefficients, axis=0)
 
     avg_zernike = WaveFitter.make_model(avg_coefficients, as_image=True)
     avg_zernike.zoom(48/256.)
 
-    ## Subtract average zernike from each wavefront
-    for wavefront in wavefront_list:
-        wavefront.data -= avg_zernike.data
+    ## Subtract average zernike from each wavefront (leaves inputs untouched)
+    wavefront_list = [Image(wavefront.data - avg_zernike.data, 
+                            wavefront.pixscale) 
+                      for wavefront in wavefront_list]
 
     ## Calculate correlation function
     r, xi, varxi = avg_xi_r(wavefront_list, telescope_name, pixscale, **kwargs)
@@ -131,18 +131,19 @@ def pupil_xi_r(telescope_name, **kwargs):
 
     rand_phase = Image(np.random.randn(256, 256))
 
-   ## Get telescope from available telescopes in a dictionary
-    telescope = TELESCOPE_DICT[telescope_name]
-    pupil_mask = telescope.get_pupil((256, 256), pix_scale=7.77/43*48/256.)
+   ## Get cached pupil for telescope from available telescopes
+    pupil_mask, ii, jj = get_cached_pupil(telescope_name, (256, 256), 
+                                          GPI_PIXSCALE*48/256.)
 
     ## Make catalogs from wavefront list
-    catalog = image_to_catalog(rand_phase, pupil_mask, is_centered=True)
+    catalog = utils.image_to_catalog(rand_phase, pupil_mask, is_centered=True,
+                                     indices=(ii, jj))
     dd = treecorr.KKCorrelation(nbins=15, min_sep=1., max_sep=40)
     dd.process(catalog)
 
     xi = dd.xi
     varxi = dd.varxi
-    r = 7.77/43.*np.exp(dd.logr)
+    r = GPI_PIXSCALE*np.exp(dd.logr)
 
     if 'save_file' in kwargs:
         np.savetxt(kwargs['save_file'], np.transpose([r, xi, varxi]))
@@ -157,106 +158,79 @@ def pupil_xi_r(telescope_name, **kwargs):
 ##
 ###############################################################################
 
-def avg_xi_t(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
+def _temporal_xi(ts):
+    """Calculate the autocorrelation of each time series (row) in ts for all 
+       integer lags using FFTs (Wiener-Khinchin)"""
+
+    nT = ts.shape[1]
+
+    ## Zero pad to 2*nT to avoid circular wrap-around
+    F = np.fft.rfft(ts, n=2*nT, axis=1)
+    xi = np.fft.irfft(F.real**2 + F.imag**2, n=2*nT, axis=1)[:, :nT]
+
+    ## Normalize by number of pairs at each lag
+    npairs = nT - np.arange(nT)
+    xi /= npairs
+    varxi = np.var(ts, axis=1)[:, None]**2/npairs
 
-    ##### Add in calculation of zero point
+    return xi, varxi
+
+def avg_xi_t(wavefront_list, telescope_name, pixscale=GPI_PIXSCALE, **kwargs):
    
     wavefront_list = copy.deepcopy(wavefront_list)
 
-    ## Get telescope from available telescopes in a dictionary
-    telescope = TELESCOPE_DICT[telescope_name]
-    pupil_mask = telescope.get_pupil((48, 48), pix_scale=pixscale)
+    ## Get cached pupil for telescope from available telescopes
+    pupil_mask, ii, jj = get_cached_pupil(telescope_name, (48, 48), pixscale)
 
     ## Mean center all wavefronts
     for wavefront in wavefront_list:
         wavefront.mean_center(mask=pupil_mask)
 
-    imagedata = np.array([wavefront.data for wavefront in wavefront_list])
+    shape = wavefront_list[0].data.shape
+    imagedata = np.empty((len(wavefront_list),) + shape, 
+                         dtype=wavefront_list[0].data.dtype)
+    for t, wavefront in enumerate(wavefront_list):
+        imagedata[t] = wavefront.data
 
     nT = imagedata.shape[0]
-    nX = imagedata.shape[1]
-    nY = imagedata.shape[2]
-
-    x = np.zeros(nT)
-    xi = []
-    varxi = []
-
-    for i in range(nX):
-        for j in range(nY):
-            if not pupil_mask[i, j]:
-                t = []
-                w = []
-                for k in range(nT):
-                    t.append(k)
-                    w.append(imagedata[k, i, j])
 
-                t = np.array(t)
-                w = np.array(w)
+    ## Gather unmasked pixels into pixel-major layout, shape (Npix, nT), so
+    ## each time series is contiguous
+    ts = np.ascontiguousarray(imagedata[:, ii, jj].T)
 
-                ## Create the data and random catalogs
-                data = treecorr.Catalog(x=x, y=t, k=w)
+    ## Calculate xi for all pixels at once
+    xi, varxi = _temporal_xi(ts)
 
-                ## Create correlation objects
-                dd = treecorr.KKCorrelation(nbins=50,  min_sep=1, max_sep=round(nT, -3))
-
-                ## Process the catalogs
-                dd.process(data)
-
-                xi.append(dd.xi)
-                varxi.append(dd.varxi)
-
-    xi = np.array(xi)
-    varxi = np.array(varxi)
     avg_xi = np.mean(xi, axis=0)
     avg_varxi = np.mean(varxi, axis=0)
-    r = np.exp(dd.logr)
+    r = np.arange(nT, dtype=np.float64)
 
     if 'save_file' in kwargs:
         np.savetxt(kwargs['save_file'], np.transpose([r, avg_xi, avg_varxi]))
     if 'save_graph' in kwargs:
         waveplot.line(r, avg_xi, **kwargs) 
 
-def zernike_xi_t(coefficients):
+    return r, avg_xi, avg_varxi
 
-    ##### Add in calculation of zero point
+def zernike_xi_t(coefficients):
 
     ## Mean center zernike coefficients
     avg_coefficients = np.mean(coefficients, axis=0, keepdims=True)
     coefficients = coefficients - avg_coefficients
 
     nT = coefficients.shape[0]
-    nZ = coefficients.shape[1]
-
-    xi = []
-
-    x = np.zeros(nT)
-
-    for i in range(nZ):
 
-        t = [] 
-        w = []
+    ## Calculate xi for all zernike coefficients at once
+    xi, varxi = _temporal_xi(coefficients.T)
 
-        for k in range(nT):
-            t.append(k)
-            w.append(coefficients[k,i])
-
-        t = np.array(t)
-        w = np.array(w)
-
-        ## Create catalog and calculate correlation
-        data = treecorr.Catalog(x=x, y=t, k=w)
-        dd = treecorr.KKCorrelation(nbins=50,  min_sep=1, max_sep=round(nT, -3))
-        dd.process(data)
-        xi.append(dd.xi)
-
-    logt = dd.logr
+    t = np.arange(nT, dtype=np.float64)
 
     fig1, axes1 = plt.subplots(nrows=2, ncols=3, sharex='col')
     fig1.suptitle(r"$\xi(\Delta t) = \langle a_i(t)a_i(t+\Delta t)\rangle $", fontsize=34)
 
     for i, ax in enumerate(axes1.flatten()):
 
-        img = ax.plot(np.exp(logt), xi[i+1])
+        img = ax.plot(t, xi[i+1])
         ax.set_title(r"$Z_{{{}}}(t)$".format(i+2), fontsize=22)
         ax.minorticks_on()
         ax.grid(b=True, which='major', color='black', linestyle='-')
@@ -280,11 +254,15 @@ def corr2struct(r, xi, varxi, num_points=10, **kwargs):
 
     num = num_points
 
-    struct = 2*(xi[0]-xi)
+    ## Compute in place to avoid temporary arrays
+    struct = np.subtract(xi[0], xi, out=np.empty_like(xi))
+    struct *= 2.
     ## Add modifications to varxi here
-    varstruct = 2*(varxi[0]+varxi)
+    varstruct = np.add(varxi[0], varxi, out=np.empty_like(varxi))
+    varstruct *= 2.
 
-    C, success = leastsq(utils.residuals, [0, 1, 5/3.], args=(struct[0:num], r[0:num]))
+    C, success = leastsq(utils.residuals, [0, 1, 5/3.], 
+                         args=(struct[:num], r[:num]))
 
     rfit = np.linspace(r[0], r[num]+1.0, 50)
 
@@ -313,35 +291,49 @@ def corr2struct(r, xi, varxi, num_points=10, **kwargs):
 def struct_dt(T, Y, maxr, npoints=10.):
 
     bounds = np.linspace(0, maxr, npoints+1)
-    bins = [(bounds[i], bounds[i+1]) for i in range(len(bounds)-1)]
-
-    num_points = len(T)
-    
-    T = T[:,None]
-    tree = BallTree(T)
-
-    R = np.zeros(len(bins)+1)
-    S_r = np.zeros(len(bins)+1)
-
-    ## Iterate over each bin
-    for i, bin in enumerate(bins):
-
-        ## Get neighbors within upper and lower bound for each point in T
-        rlow = tree.query_radius(T, r=bin[0])
-        rhigh = tree.query_radius(T, r=bin[1])
-
-        S = []
-
-        ## Iterate over results for each point
-        for j in range(num_points):
-
-            ## Find neighbors within radial shell
-            indices = np.setdiff1d(rhigh[j], rlow[j])
-            if len(indices) > 0:
-                S.append(np.mean(np.square(Y[indices]-Y[j])))
-
-        R[i+1] = (bin[0]+bin[1])/2.
-        S_r[i+1] = np.mean(S)
+    nbins = len(bounds)-1
+
+    ## Sort points so neighbors are found by their offset in sorted order
+    T = np.ravel(T)
+    order = np.argsort(T)
+    T = T[order]
+    Y = np.ravel(Y)[order]
+    npts = len(T)
+
+    ## Per point and per bin sums of squared differences, and counts
+    sums = np.zeros(npts*nbins)
+    counts = np.zeros(npts*nbins)
+
+    ## Visit all pairs with index offset m at once, computing each squared
+    ## difference directly, until every offset-m pair is beyond maxr
+    for m in range(1, npts):
+        dt = T[m:] - T[:-m]
+        if dt.min() > maxr:
+            break
+
+        ## Pairs at distance (bounds[i], bounds[i+1]] fall in bin i
+        b = np.searchsorted(bounds, dt) - 1
+        valid = (b >= 0) & (b < nbins)
+        b = b[valid]
+        d = ((Y[m:] - Y[:-m])**2)[valid]
+
+        ## Add each pair to both of its points
+        first = np.arange(npts-m)[valid]
+        for j in (first, first+m):
+            sums += np.bincount(j*nbins + b, weights=d, minlength=npts*nbins)
+            counts += np.bincount(j*nbins + b, minlength=npts*nbins)
+
+    sums = sums.reshape(npts, nbins)
+    counts = counts.reshape(npts, nbins)
+
+    ## Mean squared difference to neighbors in each shell for each point
+    S = sums/np.maximum(counts, 1)
+    has_neighbors = counts > 0
+
+    R = np.zeros(len(bounds))
+    S_r = np.zeros(len(bounds))
+    R[1:] = (bounds[:-1]+bounds[1:])/2.
+    S_r[1:] = (S*has_neighbors).sum(axis=0)/has_neighbors.sum(axis=0)
 
     plt.plot(R, S_r)
     plt.show()
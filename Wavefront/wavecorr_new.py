@@ -29,15 +29,45 @@
 ##
 
 from wavefront import Image, WaveFitter
-from telescope import Telescope, TELESCOPE_DICT
+from telescope import Telescope, TELESCOPE_DICT, get_cached_pupil
 import utils
 import copy
+import weakref
 import waveplot
 import treecorr
 import numpy as np
-from sklearn.neighbors import KDTree
+from scipy.optimize import leastsq
+from numba import njit, prange
+from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 
+## GPI pupil pixel scale (m/pixel), also used to convert separations to m
+GPI_PIXSCALE = 7.77/43.
+
+###############################################################################
+##
+## Bootstrap Kernel
+##
+###############################################################################
+
+@njit(parallel=True)
+def _bootstrap_mean(x, bootnum, samples, seed):
+    """Bootstrap resample x with replacement and return the mean of each
+       resample. Each resample b is drawn from a generator seeded with 
+       seed+b so results are reproducible regardless of threading"""
+
+    n = len(x)
+    means = np.empty(bootnum)
+
+    for b in prange(bootnum):
+        np.random.seed(seed + b)
+        s = 0.0
+        for i in range(samples):
+            s += x[np.random.randint(0, n)]
+        means[b] = s/samples
+
+    return means
+
 ###############################################################################
 ##
 ## Catalog Object
@@ -64,7 +94,8 @@ class WaveCatalog(treecorr.Catalog):
     def is_centered(self): return self._is_centered
 
     @classmethod 
-    def spatial_catalog(cls, image_list, mask=None, is_centered=True):
+    def spatial_catalog(cls, image_list, mask=None, is_centered=True, 
+                        indices=None):
 
         ## Check if single image or list of images provided
         if not isinstance(image_list, list): image_list=[image_list]
@@ -73,8 +104,6 @@ class WaveCatalog(treecorr.Catalog):
 
         ## Get shape parameters
         shape = image_list[0].data.shape
-        nX = shape[0]
-        nY = shape[1]
 
         catalog_list = []
 
@@ -82,28 +111,22 @@ class WaveCatalog(treecorr.Catalog):
         if (mask is None) or (mask.shape != shape):
             mask = np.ma.make_mask_none(shape)
 
-        ## Create catalog for each image and add to list
-        for image in image_list:
-            
-            ## Check mean centered flag
-            if is_centered: image.mean_center(mask=mask)
-
-            x = []
-            y = []
-            k = []
-
-            ## Add unmasked points to data vectors
-            for i in range(nX):
-                for j in range(nY):
-                    if not mask[i,j]:
-                        x.append(float(i))
-                        y.append(float(j))
-                        w.append(image.data[i,j])
-
-            x = np.array(x)
-            y = np.array(y)
-            k = np.array(k)
+        ## Unmasked pixel coordinates are shared by all images
+        if indices is None: indices = np.nonzero(~mask)
+        ii, jj = indices
+        x = ii.astype(np.float64)
+        y = jj.astype(np.float64)
+
+        ## Gather unmasked points of all images, shape (Nimages, Npix)
+        ks = np.empty((len(image_list), len(ii)))
+        for n, image in enumerate(image_list):
+            ks[n] = image.data[ii, jj]
+
+        ## Check mean centered flag
+        if is_centered: ks -= ks.mean(axis=1, keepdims=True)
 
+        ## Create catalog for each image and add to list
+        for k in ks:
             catalog_list.append(cls(x=x, y=y, k=k, is_centered=is_centered))
 
         return catalog_list
@@ -118,6 +141,7 @@ class WaveCatalog(treecorr.Catalog):
             raise ValueError("Must provided multiple images")
 
         ## Check if mask provided is valid
+        shape = image_list[0].data.shape
         if (mask is None) or (mask.shape != shape):
             mask = np.ma.make_mask_none(shape)
 
@@ -126,31 +150,25 @@ class WaveCatalog(treecorr.Catalog):
             image.mean_center(mask=mask)
 
         ## Create 3d NumPy array and get shape parameters
-        imagedata = np.array([image.data for image in image_list])
+        imagedata = np.empty((len(image_list),) + shape, 
+                             dtype=image_list[0].data.dtype)
+        for t, image in enumerate(image_list):
+            imagedata[t] = image.data
         nT = imagedata.shape[0]
-        nX = imagedata.shape[1]
-        nY = imagedata.shape[2]
 
         ## X data vector is zero for all catalogs since 1D data 
         x = np.zeros(nT)
+        t = np.arange(nT, dtype=np.float64)
         catalog_list = []
 
-        for i in range(nX):
-            for j in range(nY):
-
-                ## Construct catalog for unmasked points
-                if not mask[i, j]:
-                    y = []
-                    k = []
-                    for t in range(nT):
-                        y.append(t)
-                        k.append(imagedata[t, i, j])
-
-                    y = np.array(y)
-                    k = np.array(k)
+        ## Gather unmasked points into pixel-major layout, shape (Npix, nT),
+        ## so each time series is contiguous
+        ii, jj = np.nonzero(~mask)
+        ts = np.ascontiguousarray(imagedata[:, ii, jj].T)
 
-                    catalog_list.append(cls(x=x, y=t, k=k, 
-                                            is_centered=is_centered))
+        ## Construct catalog for unmasked points
+        for k in ts:
+            catalog_list.append(cls(x=x, y=t, k=k, is_centered=is_centered))
 
         return catalog_list
 
@@ -162,17 +180,20 @@ class WaveCatalog(treecorr.Catalog):
 
 class PhaseCorrelation(treecorr.KKCorrelation):
     """Class to calculate log-log spacing correlation function, and can 
-       convert to structure function in log-log spacing""".
+       convert to structure function in log-log spacing"""
 
     def __init__(self, config, logger, **kwargs):
 
-        super(PhaseCorrelation, self).__init__(config, logger, **kwargs):
+        super(PhaseCorrelation, self).__init__(config, logger, **kwargs)
 
         ## Protected variables to hold additional measurements
         self._D = None
         self._varD = None
         self._r = None
 
+        ## Cached pair results of last catalog processed with linear bins
+        self._pair_cache = None
+
     @property
     def D(self): return self._D
 
@@ -199,109 +220,157 @@ class PhaseCorrelation(treecorr.KKCorrelation):
             self._D = np.insert(struct, 0, 0.0)
             self._r = np.insert(np.exp(self.logr), 0, 0.0)
 
-    def process_linear_xi(self, cat1, bootstrap=False, bootnum=1000
-                          samples=500):
+    def _compute_pairs(self, cat1, statistic):
+        """Calculate weighted pair counts in linear radial bins needed for 
+           statistic ('xi' or 'D'), reusing cached tree and results if cat1 
+           was the last catalog processed"""
 
-        ## Clear data vectors
-        super(PhaseCorrelation, self).clear()
+        if self._pair_cache is None or self._pair_cache[0]() is not cat1:
+
+            ## Create data vector for KDTree
+            data = np.ascontiguousarray(np.column_stack((cat1.x, cat1.y)))
+            k = np.ascontiguousarray(cat1.k, dtype=np.float64)
+
+            tree = cKDTree(data)
+
+            ## Build radial bins
+            rlimits = np.linspace(self.min_sep, self.max_sep, self.nbins+1)
+
+            self._pair_cache = (weakref.ref(cat1), 
+                                (tree, data, k, rlimits, {}))
+
+        tree, data, k, rlimits, stats = self._pair_cache[1]
+
+        ## Sum of w1_i*w2_j over pairs in each bin, dropping d <= min_sep
+        def paircount(w1, w2):
+            return tree.count_neighbors(tree, rlimits, weights=(w1, w2),
+                                        cumulative=False)[1:]
+
+        if 'counts' not in stats:
+            stats['counts'] = tree.count_neighbors(tree, rlimits, 
+                                                   cumulative=False)[1:]
+
+        if statistic not in stats:
+            if statistic == 'xi':
+
+                ## Sums of k_i*k_j and its square
+                stats['xi'] = (paircount(k, k), paircount(k**2, k**2))
+
+            elif statistic == 'D':
+
+                ## D does not depend on the mean, so remove it before
+                ## expanding to avoid cancellation for offset data
+                kc = k - k.mean()
+                ones = np.ones_like(kc)
+                s11 = paircount(kc, kc)
+                s20 = paircount(kc**2, ones)
+                s22 = paircount(kc**2, kc**2)
+                s31 = paircount(kc**3, kc)
+                s40 = paircount(kc**4, ones)
+
+                ## Sums of (k_i-k_j)**2 and its square, using the symmetry 
+                ## of ordered pairs to expand into moments
+                stats['D'] = (2*s20 - 2*s11, 2*s40 - 8*s31 + 6*s22)
+
+        return tree, data, k, rlimits, stats['counts'], stats[statistic]
+
+    @staticmethod
+    def _enumerate_pairs(tree, data, rlimits):
+        """Return the two point indices and radial bin index of every pair
+           within the largest bin limit"""
+
+        ind = tree.query_ball_point(data, r=rlimits[-1], return_sorted=False)
+
+        first = np.repeat(np.arange(len(ind)), [len(a) for a in ind])
+        second = np.concatenate(ind).astype(np.intp)
+        dist = np.sqrt(np.sum((data[first]-data[second])**2, axis=1))
+        bin_index = np.searchsorted(rlimits, dist) - 1
 
-        ## Create data vector for KDTree
-        data = np.array([[cat1.x[i], cat1.y[i]] for i in range(len(cat1.x))])
-        k = cat1.k
+        return first, second, bin_index
 
-        tree = KDTree(data)
+    def process_linear_xi(self, cat1, bootstrap=False, bootnum=1000,
+                          samples=500, seed=None):
 
-        ## Build radial bins
-        rlimits = np.linspace(self.min_sep, self.max_sep, nbins)
-        rbins = [(rlimits[i], rlimits[i+1]) for i in range(len(bin_limits)-1)]
+        ## Clear data vectors
+        super(PhaseCorrelation, self).clear()
 
-        ## Initialize results vectors
-        xi = np.zeros(len(rbins))
-        varxi = np.zeros(len(rbins))
-        r = np.array([(rbin[1]+rbin[0])/2. for rbin in rbins])
+        tree, data, k, rlimits, counts, (sums, sqsums) = \
+            self._compute_pairs(cat1, 'xi')
 
-        ## Loop over each radial bin
-        for i, rbin in enumerate(rbins):
+        ## Radial bin centers
+        r = (rlimits[:-1]+rlimits[1:])/2.
 
-            xi_samples = []
+        xi = sums/counts
+        varxi = sqsums/counts - xi**2
 
-            ## For each data point, find neighbors in radial shell
-            for j, point in enumerate(data):
+        ## Perform bootstrapping if desired
+        if bootstrap:
+            first, second, bin_index = self._enumerate_pairs(tree, data, 
+                                                             rlimits)
+            pair_xi = k[first]*k[second]
 
-                high = tree.query_radius(point, rbin[1])
-                low = tree.query_radius(point, rbin[0])
-                shell = np.setxor1d(high[0], low[0])
+            ## Draw base seed from NumPy so np.random.seed controls results
+            if seed is None:
+                seed = np.random.randint(0, 2**31 - 1 - bootnum)
 
-                ## Calculate D and xi samples for each point
-                 xi_samples.extend([k[j]*k[neighbor] for neighbor in shell])
+            for i in range(len(r)):
+                bin_samples = pair_xi[bin_index == i]
 
-            xi_samples = np.array(xi_samples)
-            xi[i] = xi_samples.mean()
+                ## Skip empty bins, matching the NaN of the non-bootstrap path
+                if len(bin_samples) == 0:
+                    varxi[i] = np.nan
+                    continue
 
-            ## Perform bootstrapping if desired
-            if bootstrap = True:
-                xi_bootstraps = bootstrap(xi_samples, bootnum=bootnum, 
-                                         samples=samples, bootfunc=np.mean)
+                xi_bootstraps = _bootstrap_mean(bin_samples, bootnum, 
+                                                samples, seed)
                 varxi[i] = xi_bootstraps.var()
-            else:
-                varxi[i] = xi_samples.var()
 
         self.xi = xi
         self.varxi = varxi
-        self.r = r
+        self._r = r
 
     def process_linear_D(self, cat1, bootstrap=False, bootnum=1000,
-                         samples=500):
+                         samples=500, seed=None):
 
         ## Clear data vectors
         self._D = None
         self._varD = None
         self._r = None
 
-        ## Create data vector for KDTree
-        data = np.array([[cat1.x[i], cat1.y[i]] for i in range(len(cat1.x))])
-        k = cat1.k
-
-        tree = KDTree(data)
-
-        ## Build radial bins
-        rlimits = np.linspace(self.min_sep, self.max_sep, nbins)
-        rbins = [(rlimits[i], rlimits[i+1]) for i in range(len(bin_limits)-1)]
-
-        ## Initialize results vectors
-        D = np.zeros(len(rbins))
-        varD = np.zeros(len(rbins))
-        r = np.array([(rbin[1]+rbin[0])/2. for rbin in rbins])
+        tree, data, k, rlimits, counts, (sums, sqsums) = \
+            self._compute_pairs(cat1, 'D')
 
-        ## Loop over each radial bin
-        for i, rbin in enumerate(rbins):
+        ## Radial bin centers
+        r = (rlimits[:-1]+rlimits[1:])/2.
 
-            D_samples = []
+        D = sums/counts
+        varD = sqsums/counts - D**2
 
-            ## For each data point, find neighbors in radial shell
-            for j, point in enumerate(data):
+        ## Perform bootstrapping if desired
+        if bootstrap:
+            first, second, bin_index = self._enumerate_pairs(tree, data, 
+                                                             rlimits)
+            pair_D = (k[first]-k[second])**2
 
-                high = tree.query_radius(point, rbin[1])
-                low = tree.query_radius(point, rbin[0])
-                shell = np.setxor1d(high[0], low[0])
+            ## Draw base seed from NumPy so np.random.seed controls results
+            if seed is None:
+                seed = np.random.randint(0, 2**31 - 1 - bootnum)
 
-                ## Calculate D and xi samples for each point
-                D_samples.extend([(k[j]-k[neighbor])**2 for neighbor in shell])
+            for i in range(len(r)):
+                bin_samples = pair_D[bin_index == i]
 
-            D_samples = np.array(D_samples)
-            D[i] = D_samples.mean()
+                ## Skip empty bins, matching the NaN of the non-bootstrap path
+                if len(bin_samples) == 0:
+                    varD[i] = np.nan
+                    continue
 
-            ## Peform bootstrapping if desired
-            if bootstrap = True:
-                D_bootstraps = bootstrap(D_samples, bootnum=bootnum, 
-                                         samples=samples, bootfunc=np.mean)
+                D_bootstraps = _bootstrap_mean(bin_samples, bootnum, 
+                                                samples, seed)
                 varD[i] = D_bootstraps.var()
-            else:
-                varD[i] = D_sample.var()
 
-        self.D = D
-        self.varD = varD
-        self.r = r      
+        self._D = D
+        self._varD = varD
+        self._r = r      
 
 ###############################################################################
 ##
@@ -309,15 +378,13 @@ class PhaseCorrelation(treecorr.KKCorrelation):
 ##
 ###############################################################################
 
-def avg_xi_r(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
+def avg_xi_r(wavefront_list, telescope_name, pixscale=GPI_PIXSCALE, **kwargs):
 
     ## Get correlation parameters
     nbins = kwargs.pop('nbins', 15)
     min_sep = kwargs.pop('min_sep', 1.)
     max_sep = kwargs.pop('max_sep', 40)
-
-    ## Deep copy to avoid altering reusable data
-    wavefront_list = copy.deepcopy(wavefront_list)
+    num_threads = kwargs.pop('num_threads', None)
 
     ## Check that data is a list
     if not isinstance (wavefront_list,list):
@@ -325,19 +392,20 @@ def avg_xi_r(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
     if len(wavefront_list) == 0:
         raise ValueError("No wavefronts provided")
 
-    ## Get telescope from available telescopes in a dictionary
+    ## Get cached pupil for telescope from available telescopes
     shape = wavefront_list[0].data.shape
-    telescope = TELESCOPE_DICT[telescope_name]
-    pupil_mask = telescope.get_pupil(shape, pix_scale=pixscale)
+    pupil_mask, ii, jj = get_cached_pupil(telescope_name, shape, pixscale)
 
     ## Make catalogs from wavefront list
-    catalog_list = utils.image_to_catalog(wavefront_list, pupil_mask, is_centered=True)
+    catalog_list = utils.image_to_catalog(wavefront_list, pupil_mask, 
+                                          is_centered=True, 
+                                          indices=(ii, jj))
 
     ## Calculate xi/varxi zero point (variance)
-    xi_0 = np.zeros(len(wavefront_list))
+    pupil_data = np.empty((len(wavefront_list), len(ii)))
     for i, wavefront in enumerate(wavefront_list):
-        w = np.ma.MaskedArray(wavefront.data, mask=pupil_mask)
-        xi_0[i] = np.var(w)
+        pupil_data[i] = wavefront.data[ii, jj]
+    xi_0 = pupil_data.var(axis=1)
     varxi_0 = xi_0.var(dtype=np.float64)
 
     ## Initialize data vectors
@@ -348,10 +416,11 @@ def avg_xi_r(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
     xi[0,:] = xi_0
     r[0] = 0.0
 
-    ## For each catalog calculate xi using treecorr
+    ## For each catalog calculate xi using treecorr, reusing one object
+    dd = treecorr.KKCorrelation(nbins=nbins, min_sep=min_sep, max_sep=max_sep)
     for i, catalog in enumerate(catalog_list):
-        dd = treecorr.KKCorrelation(nbins=nbins, min_sep=1., max_sep=40)
-        dd.process(catalog)
+        dd.clear()
+        dd.process(catalog, num_threads=num_threads)
         xi[1:,i] = dd.xi
         varxi[1:,i] = dd.varxi
 
@@ -359,7 +428,7 @@ def avg_xi_r(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
     avg_xi = np.mean(xi, axis=1)
     avg_varxi = np.mean(varxi, axis=1)
     avg_varxi[0] = varxi_0
-    r[1:] = 7.77/43.*np.exp(dd.logr)
+    r[1:] = GPI_PIXSCALE*np.exp(dd.logr)
 
     ## Check save flags
     if 'save_file' in kwargs:
@@ -369,7 +438,7 @@ def avg_xi_r(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
 
     return r, avg_xi, avg_varxi
 
-def zernike_xi_r(coefficients, telescope_name, pixscale = 7.77/43*48/256., **kwargs):
+def zernike_xi_r(coefficients, telescope_name, pixscale = GPI_PIXSCALE*48/256., **kwargs):
     """Pixscale is smaller since zernikes are 256x256"""
 
     ## Read in file with zernike fit coefficients
@@ -379,8 +448,8 @@ def zernike_xi_r(coefficients, telescope_name, pixscale = 7.77/43*48/256., **kwa
     avg_zernike = WaveFitter.make_model(avg_coefficients, as_image=True)
 
     if 'save_image' in kwargs:
-        telescope = TELESCOPE_DICT[telescope_name]
-        pupil_mask = telescope.get_pupil((256, 256), pixscale)
+        pupil_mask, _, _ = get_cached_pupil(telescope_name, (256, 256), 
+                                            pixscale)
         avg_zernike.display(mask=pupil_mask, title='Zernike Model for GPI Pupil',
                             cbar_label=r'$\mu \mathrm{{m}}$',
                             save_image=kwargs['save_image'],
@@ -390,20 +459,18 @@ def zernike_xi_r(coefficients, telescope_name, pixscale = 7.77/43*48/256., **kwa
 
     return r, xi, varxi
     
-def residual_xi_r(wavefront_list, coefficients, telescope_name, pixscale = 7.77/43, **kwargs):
+def residual_xi_r(wavefront_list, coefficients, telescope_name, pixscale = GPI_PIXSCALE, **kwargs):
 
-    ## Deep copy to avoid altering reusable data
-    wavefront_list = copy.deepcopy(wavefront_list)
-    
     ## Construct zernike model from average coefficients
     avg_coefficients = np.mean(coefficients, axis=0)
 
     avg_zernike = WaveFitter.make_model(avg_coefficients, as_image=True)
     avg_zernike.zoom(48/256.)
 
-    ## Subtract average zernike from each wavefront
-    for wavefront in wavefront_list:
-        wavefront.data -= avg_zernike.data
+    ## Subtract average zernike from each wavefront (leaves inputs untouched)
+    wavefront_list = [Image(wavefront.data - avg_zernike.data, 
+                            wavefront.pixscale) 
+                      for wavefront in wavefront_list]
 
     ## Calculate correlation function
     r, xi, varxi = avg_xi_r(wavefront_list, telescope_name, pixscale, **kwargs)
@@ -414,18 +481,19 @@ def pupil_xi_r(telescope_name, **kwargs):
 
     rand_phase = Image(np.random.randn(256, 256))
 
-   ## Get telescope from available telescopes in a dictionary
-    telescope = TELESCOPE_DICT[telescope_name]
-    pupil_mask = telescope.get_pupil((256, 256), pix_scale=7.77/43*48/256.)
+   ## Get cached pupil for telescope from available telescopes
+    pupil_mask, ii, jj = get_cached_pupil(telescope_name, (256, 256), 
+                                          GPI_PIXSCALE*48/256.)
 
     ## Make catalogs from wavefront list
-    catalog = image_to_catalog(rand_phase, pupil_mask, is_centered=True)
+    catalog = utils.image_to_catalog(rand_phase, pupil_mask, is_centered=True,
+                                     indices=(ii, jj))
     dd = treecorr.KKCorrelation(nbins=15, min_sep=1., max_sep=40)
     dd.process(catalog)
 
     xi = dd.xi
     varxi = dd.varxi
-    r = 7.77/43.*np.exp(dd.logr)
+    r = GPI_PIXSCALE*np.exp(dd.logr)
 
     if 'save_file' in kwargs:
         np.savetxt(kwargs['save_file'], np.transpose([r, xi, varxi]))
@@ -440,106 +508,79 @@ def pupil_xi_r(telescope_name, **kwargs):
 ##
 ###############################################################################
 
-def avg_xi_t(wavefront_list, telescope_name, pixscale=7.77/43, **kwargs):
+def _temporal_xi(ts):
+    """Calculate the autocorrelation of each time series (row) in ts for all 
+       integer lags using FFTs (Wiener-Khinchin)"""
 
-    ##### Add in calculation of zero point
+    nT = ts.shape[1]
+
+    ## Zero pad to 2*nT to avoid circular wrap-around
+    F = np.fft.rfft(ts, n=2*nT, axis=1)
+    xi = np.fft.irfft(F.real**2 + F.imag**2, n=2*nT, axis=1)[:, :nT]
+
+    ## Normalize by number of pairs at each lag
+    npairs = nT - np.arange(nT)
+    xi /= npairs
+    varxi = np.var(ts, axis=1)[:, None]**2/npairs
+
+    return xi, varxi
+
+def avg_xi_t(wavefront_list, telescope_name, pixscale=GPI_PIXSCALE, **kwargs):
    
     wavefront_list = copy.deepcopy(wavefront_list)
 
-    ## Get telescope from available telescopes in a dictionary
-    telescope = TELESCOPE_DICT[telescope_name]
-    pupil_mask = telescope.get_pupil((48, 48), pix_scale=pixscale)
+    ## Get cached pupil for telescope from available telescopes
+    pupil_mask, ii, jj = get_cached_pupil(telescope_name, (48, 48), pixscale)
 
     ## Mean center all wavefronts
     for wavefront in wavefront_list:
         wavefront.mean_center(mask=pupil_mask)
 
-    imagedata = np.array([wavefront.data for wavefront in wavefront_list])
+    shape = wavefront_list[0].data.shape
+    imagedata = np.empty((len(wavefront_list),) + shape, 
+                         dtype=wavefront_list[0].data.dtype)
+    for t, wavefront in enumerate(wavefront_list):
+        imagedata[t] = wavefront.data
 
     nT = imagedata.shape[0]
-    nX = imagedata.shape[1]
-    nY = imagedata.shape[2]
-
-    x = np.zeros(nT)
-    xi = []
-    varxi = []
-
-    for i in range(nX):
-        for j in range(nY):
-            if not pupil_mask[i, j]:
-                t = []
-                w = []
-                for k in range(nT):
-                    t.append(k)
-                    w.append(imagedata[k, i, j])
-
-                t = np.array(t)
-                w = np.array(w)
-
-                ## Create the data and random catalogs
-                data = treecorr.Catalog(x=x, y=t, k=w)
 
-                ## Create correlation objects
-                dd = treecorr.KKCorrelation(nbins=50,  min_sep=1, max_sep=round(nT, -3))
+    ## Gather unmasked pixels into pixel-major layout, shape (Npix, nT), so
+    ## each time series is contiguous
+    ts = np.ascontiguousarray(imagedata[:, ii, jj].T)
 
-                ## Process the catalogs
-                dd.process(data)
+    ## Calculate xi for all pixels at once
+    xi, varxi = _temporal_xi(ts)
 
-                xi.append(dd.xi)
-                varxi.append(dd.varxi)
-
-    xi = np.array(xi)
-    varxi = np.array(varxi)
     avg_xi = np.mean(xi, axis=0)
     avg_varxi = np.mean(varxi, axis=0)
-    r = np.exp(dd.logr)
+    r = np.arange(nT, dtype=np.float64)
 
     if 'save_file' in kwargs:
         np.savetxt(kwargs['save_file'], np.transpose([r, avg_xi, avg_varxi]))
     if 'save_graph' in kwargs:
         waveplot.line(r, avg_xi, **kwargs) 
 
-def zernike_xi_t(coefficients):
+    return r, avg_xi, avg_varxi
 
-    ##### Add in calculation of zero point
+def zernike_xi_t(coefficients):
 
     ## Mean center zernike coefficients
     avg_coefficients = np.mean(coefficients, axis=0, keepdims=True)
     coefficients = coefficients - avg_coefficients
 
     nT = coefficients.shape[0]
-    nZ = coefficients.shape[1]
-
-    xi = []
-
-    x = np.zeros(nT)
-
-    for i in range(nZ):
-
-        t = [] 
-        w = []
-
-        for k in range(nT):
-            t.append(k)
-            w.append(coefficients[k,i])
-
-        t = np.array(t)
-        w = np.array(w)
 
-        ## Create catalog and calculate correlation
-        data = treecorr.Catalog(x=x, y=t, k=w)
-        dd = treecorr.KKCorrelation(nbins=50,  min_sep=1, max_sep=round(nT, -3))
-        dd.process(data)
-        xi.append(dd.xi)
+    ## Calculate xi for all zernike coefficients at once
+    xi, varxi = _temporal_xi(coefficients.T)
 
-    logt = dd.logr
+    t = np.arange(nT, dtype=np.float64)
 
     fig1, axes1 = plt.subplots(nrows=2, ncols=3, sharex='col')
     fig1.suptitle(r"$\xi(\Delta t) = \langle a_i(t)a_i(t+\Delta t)\rangle $", fontsize=34)
 
     for i, ax in enumerate(axes1.flatten()):
 
-        img = ax.plot(np.exp(logt), xi[i+1])
+        img = ax.plot(t, xi[i+1])
         ax.set_title(r"$Z_{{{}}}(t)$".format(i+2), fontsize=22)
         ax.minorticks_on()
         ax.grid(b=True, which='major', color='black', linestyle='-')
@@ -563,11 +604,15 @@ def corr2struct(r, xi, varxi, num_points=10, **kwargs):
 
     num = num_points
 
-    struct = 2*(xi[0]-xi)
+    ## Compute in place to avoid temporary arrays
+    struct = np.subtract(xi[0], xi, out=np.empty_like(xi))
+    struct *= 2.
     ## Add modifications to varxi here
-    varstruct = 2*(varxi[0]+varxi)
+    varstruct = np.add(varxi[0], varxi, out=np.empty_like(varxi))
+    varstruct *= 2.
 
-    C, success = leastsq(utils.residuals, [0, 1, 5/3.], args=(struct[0:num], r[0:num]))
+    C, success = leastsq(utils.residuals, [0, 1, 5/3.], 
+                         args=(struct[:num], r[:num]))
 
     rfit = np.linspace(r[0], r[num]+1.0, 50)
 
@@ -596,35 +641,49 @@ def corr2struct(r, xi, varxi, num_points=10, **kwargs):
 def struct_dt(T, Y, maxr, npoints=10.):
 
     bounds = np.linspace(0, maxr, npoints+1)
-    bins = [(bounds[i], bounds[i+1]) for i in range(len(bounds)-1)]
-
-    num_points = len(T)
-    
-    T = T[:,None]
-    tree = BallTree(T)
-
-    R = np.zeros(len(bins)+1)
-    S_r = np.zeros(len(bins)+1)
-
-    ## Iterate over each bin
-    for i, bin in enumerate(bins):
-
-        ## Get neighbors within upper and lower bound for each point in T
-        rlow = tree.query_radius(T, r=bin[0])
-        rhigh = tree.query_radius(T, r=bin[1])
-
-        S = []
-
-        ## Iterate over results for each point
-        for j in range(num_points):
-
-            ## Find neighbors within radial shell
-            indices = np.setdiff1d(rhigh[j], rlow[j])
-            if len(indices) > 0:
-                S.append(np.mean(np.square(Y[indices]-Y[j])))
-
-        R[i+1] = (bin[0]+bin[1])/2.
-        S_r[i+1] = np.mean(S)
+    nbins = len(bounds)-1
+
+    ## Sort points so neighbors are found by their offset in sorted order
+    T = np.ravel(T)
+    order = np.argsort(T)
+    T = T[order]
+    Y = np.ravel(Y)[order]
+    npts = len(T)
+
+    ## Per point and per bin sums of squared differences, and counts
+    sums = np.zeros(npts*nbins)
+    counts = np.zeros(npts*nbins)
+
+    ## Visit all pairs with index offset m at once, computing each squared
+    ## difference directly, until every offset-m pair is beyond maxr
+    for m in range(1, npts):
+        dt = T[m:] - T[:-m]
+        if dt.min() > maxr:
+            break
+
+        ## Pairs at distance (bounds[i], bounds[i+1]] fall in bin i
+        b = np.searchsorted(bounds, dt) - 1
+        valid = (b >= 0) & (b < nbins)
+        b = b[valid]
+        d = ((Y[m:] - Y[:-m])**2)[valid]
+
+        ## Add each pair to both of its points
+        first = np.arange(npts-m)[valid]
+        for j in (first, first+m):
+            sums += np.bincount(j*nbins + b, weights=d, minlength=npts*nbins)
+            counts += np.bincount(j*nbins + b, minlength=npts*nbins)
+
+    sums = sums.reshape(npts, nbins)
+    counts = counts.reshape(npts, nbins)
+
+    ## Mean squared difference to neighbors in each shell for each point
+    S = sums/np.maximum(counts, 1)
+    has_neighbors = counts > 0
+
+    R = np.zeros(len(bounds))
+    S_r = np.zeros(len(bounds))
+    R[1:] = (bounds[:-1]+bounds[1:])/2.
+    S_r[1:] = (S*has_neighbors).sum(axis=0)/has_neighbors.sum(axis=0)
 
     plt.plot(R, S_r)
     plt.show()
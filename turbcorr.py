@@ -55,16 +55,20 @@ def linStruct(image, mask, nbins=10, start=0.5, stop=40.):
     tree = KDTree(data)
     
     ## Construct radial bins
-    rbins = np.linspace(start, stop, nbins)
-    rbins = [(rbins[i], rbins[i+1]) for i in range(len(rbins)-1)]
+    rlimits = np.linspace(start, stop, nbins)
+    lo = rlimits[:-1]
+    hi = rlimits[1:]
     
     ## Construct arrays to hold results  
-    D = np.zeros(len(rbins))
-    varD = np.zeros(len(rbins))
-    r = np.array([image.pix_scale*(rbin[1]+rbin[0])/2. for rbin in rbins])
+    D = np.zeros(len(lo))
+    varD = np.zeros(len(lo))
+    r = image.pix_scale*(lo+hi)/2.
+
+    ## Find neighbors within the largest radius in a single query
+    ind, dist = tree.query_radius(data, r=stop, return_distance=True)
     
     ## Loop through each bin
-    for i, rbin in enumerate(rbins):
+    for i, (lo_i, hi_i) in enumerate(zip(lo, hi)):
         
         D_samples = []
         
@@ -72,9 +76,8 @@ def linStruct(image, mask, nbins=10, start=0.5, stop=40.):
         for j, point in enumerate(data):
             
             ## Find data points within a radial shell
-            high = tree.query_radius(point, rbin[1])
-            low = tree.query_radius(point, rbin[0])
-            shell = np.setxor1d(high[0], low[0])
+            sel = (dist[j] > lo_i) & (dist[j] <= hi_i)
+            shell = ind[j][sel]
             
             ## For each point in shell, calculate D_sample
             D_samples.extend([(image.data[tuple(point)]-image.data[tuple(data[k])])**2 for k in shell])